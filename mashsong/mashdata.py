@@ -1,23 +1,24 @@
 from __future__ import annotations, division
 
-import os, io, json, asyncio, logging
+import os, glob, time, asyncio, hashlib, logging, functools
 from pathlib import Path
 
-import numpy as np, pandas as pd, music21.key as key
-from pyrubberband.pyrb import __rubberband as pyrb; from scipy.io import wavfile
-from pydub import AudioSegment; from spotipy import Spotify, SpotifyClientCredentials;
+import numpy as np, music21.key as key, soundfile as sf, orjson
+from spotipy import Spotify, SpotifyClientCredentials;
+from numba import njit
 
 from pedalboard import *
+from pedalboard import time_stretch
 from pedalboard.pedalboard import Pedalboard
 
-from typing import Tuple, Dict, List
+from typing import Tuple, Dict, List, ClassVar, Optional
 from numpy.typing import NDArray, ArrayLike
 
 # from pyrubberband import pyrb
 
 logger = logging.getLogger(__name__)
-__notes: list[str] = ['C','C#','D','D#','E','F','F#','G','G#','A','A#','B']
-__modes: list[str] = ['minor', 'major']
+_notes: list[str] = ['C','C#','D','D#','E','F','F#','G','G#','A','A#','B']
+_modes: list[str] = ['minor', 'major']
 
 class Section:
 	''' Defines data object that contains spotify analysis section data.
@@ -61,26 +62,18 @@ class Section:
 		self.time_signature = (section_data['time_signature'], 
 							section_data['time_signature_confidence'])
 	
-	def sync_to_measure(self) -> int:
+	def sync_to_measure(self, measures: NDArray[np.float32], start_ind: int, end_ind: int) -> int:
 		''' Sets start_time and duration to sync with closest measure times
-			(Must be called from MashSong methods)
+			(Must be called from MashSong methods, indexes come from _sync_all)
 			Returns the end index to begin from the next iteration
 		'''
-		start_ind: int = 0
-		end_ind: int = np.searchsorted(self.track_measures, self.end_time, "left")-1
-		if(end_ind >= len(self.track_measures)-1):
-			end_ind = end_ind - 1
-
-		if(self.end_time-self.track_measures[end_ind] > self.track_measures[end_ind+1]-self.end_time):
-			end_ind = end_ind + 1
-		
 		#self.logger.info(f"Orig Times: {self.start_time} - {self.start_time+self.duration}")
-		self.start_time = self.track_measures[start_ind]
-		self.end_time = self.track_measures[end_ind]
+		self.start_time = measures[start_ind]
+		self.end_time = measures[end_ind]
 		#self.logger.info(f"Extended by {self.end_time-self.start_time - self.duration}")
 		self.duration = self.end_time - self.start_time
-		self.track_measures = self.track_measures[start_ind:end_ind]
-		#self.logger.info(f"Synced to {self.start_time} - {self.end_time}, spanning {end_ind} measures")
+		self.track_measures = measures[start_ind:end_ind]
+		#self.logger.info(f"Synced to {self.start_time} - {self.end_time}, spanning {end_ind-start_ind} measures")
 		return end_ind
 
 	def __str__(self) -> str:
@@ -104,32 +97,51 @@ class MashSong:
 	duration: float
 	sections: List[Section]
 	measures: ArrayLike
-	stems: Dict[str,AudioSegment]
+	stems: Dict[str,NDArray[np.float32]]
+
+	_spotify: ClassVar[Optional[Spotify]] = None	# Shared client, see _get_spotify
 
-	def __init__(self, title: str, info: dict) -> None:
+	def __init__(self, title: str, info: dict, stems: Dict[str,NDArray[np.float32]] = None) -> None:
 		self.title = title
 		self.logger = logging.getLogger(f"mashdata.mashsong.{title}")
 		self.key_no = int(info['track']['key'])
-		self.mode = __modes[int(info['track']['mode'])]
-		self.key = key.Key(__notes[self.key_no], self.mode)	# int(0-11) that maps C, C#,...B
+		self.mode = _modes[int(info['track']['mode'])]
+		self.key = _make_key(_notes[self.key_no], self.mode)	# int(0-11) that maps C, C#,...B
 		self.bpm = float(info['track']['tempo'])
 		self.duration = float(info['track']['duration'])
 		self.logger.info(f"Measure Length: {(60/self.bpm)*16}")
 		self.sections = [Section(section, ind, title) for ind, section in enumerate(info['sections'])]
-		self.measures = np.append(bars_to_measures(info['bars']),self.duration)
-		self.stems = self.fetch_stems()
+		self._ingest(info)
+		self.measures = np.append(bars_to_measures(self._bars_start),self.duration)
+		self.stems = stems if stems is not None else self.fetch_stems()
 		self.sync_sections_to_measures()
+		# Section indexes by synced duration, longest first
+		self._by_duration = sorted(range(len(self.sections)), 
+								key=lambda ind: self.sections[ind].duration, reverse=True)
+
+	def _ingest(self, info: dict) -> None:
+		''' Converts analysis lists of dicts into one float32 array per field, once per track
+			(measure helpers then work on views of these)
+		'''
+		self._bars_start = field_array(info['bars'], 'start')
+		self._bars_conf = field_array(info['bars'], 'confidence')
+		self._beats_start = field_array(info['beats'], 'start')
+		self._beats_conf = field_array(info['beats'], 'confidence')
+		self._segments_start = field_array(info['segments'], 'start')
+		self._segments_loudness = field_array(info['segments'], 'loudness_max')
 
 	@classmethod
 	def get_song_from_search(
 				cls: type, title: str, artist: str = None, 
-				save_data: bool = True) -> MashSong:
+				save_data: bool = True, 
+				stems: Dict[str,NDArray[np.float32]] = None) -> MashSong:
 		'''	Class Function that returns a new MashSong object based on Spotify API search
 		
 		Args:
 			title (str): Track title
 			artist (str): Artist name (optional)
 			save_data (bool): Whether to save track info to .json locally
+			stems (dict): Already separated stems, skips reading stem wavs (optional)
 
 		Returns:
 			MashSong object with title and info
@@ -139,19 +151,34 @@ class MashSong:
 			query += f' artist:{artist}'
 		query.replace(' ', '%20')
 		
-		spotify: Spotify = Spotify(client_credentials_manager=SpotifyClientCredentials(), requests_timeout=20)
-		uri: str = spotify.search(query, 1)['tracks']['items'][0]['uri']
-		info: Dict = spotify.audio_analysis(uri)
+		cache_path: Path = Path.cwd() / 'data' / 'info' / '.cache'
+		cache_file: Path = cache_path / f'{hashlib.sha1(query.encode()).hexdigest()}.json'
+		if cache_file.is_file():
+			info: Dict = orjson.loads(cache_file.read_bytes())
+		else:
+			uri: str = spotify_search(query)['tracks']['items'][0]['uri']
+			info: Dict = spotify_audio_analysis(uri)
+			cache_path.mkdir(parents=True, exist_ok=True)
+			tmp_file: Path = cache_file.with_suffix('.tmp')
+			tmp_file.write_bytes(orjson.dumps(info))
+			tmp_file.replace(cache_file)
 		title: str = title.title().replace(' ', '') + artist.title().replace(' ', '')
 
 		if save_data:
 			path: Path = Path.cwd() / 'data' / 'info'
 			file: Path = path / f'{title}.json'
-			with open(file, 'w') as f:
-				json.dump(info, f)
+			file.write_bytes(orjson.dumps(info))
 		
-		return MashSong(title, info)
+		return MashSong(title, info, stems)
 	
+	@classmethod
+	def _get_spotify(cls) -> Spotify:
+		'''	Returns Spotify client shared by all MashSongs, creating it (and its token) on first call
+		'''
+		if cls._spotify is None:
+			cls._spotify = Spotify(client_credentials_manager=SpotifyClientCredentials(), requests_timeout=20)
+		return cls._spotify
+
 	@classmethod
 	def get_song_from_json(cls, filename: str) -> MashSong:
 		'''	Takes json filename and returns loaded MashSong object
@@ -164,24 +191,32 @@ class MashSong:
 		'''
 		path: Path = Path.cwd() / 'data' / 'info'
 		file: Path = path / filename
-		with file.open() as f:
-			info: Dict = json.load(f)
+		info: Dict = _load_info(str(file))
 		title: str = filename.removesuffix('.json')
 		return MashSong(title, info)
 
-	def fetch_stems(self) -> Dict[AudioSegment]:
+	def fetch_stems(self) -> Dict[str,NDArray[np.float32]]:
+		''' Reads this track's stem wavs as float32 (frames, channels) arrays
+		'''
 		stem_path: Path = Path.cwd() / 'data' / 'music' / 'out'
-		stems: Dict[AudioSegment] = {}
-		for file in os.listdir(stem_path):
-			if file.lower().find(self.title.lower()) != -1:
-				stem: AudioSegment = AudioSegment.from_file(stem_path/file, format="wav")
-				stems[file.removeprefix(self.title).removesuffix(".wav")] = stem
+		stems: Dict[str,NDArray[np.float32]] = {}
+		# Stems are saved as {title}{Stem}.wav by Masher.separate
+		for file in stem_path.glob(f'{glob.escape(self.title)}*.wav'):
+			samples, sr = sf.read(file, dtype='float32', always_2d=True)
+			assert sr == self.FRAME_RATE, f"{file.name} is {sr}Hz, expected {self.FRAME_RATE}Hz"
+			stems[file.stem.removeprefix(self.title)] = samples
 		return stems
+
+	def get_stem_slice(self, type: str, start_time: float = 0, end_time: float = None) -> NDArray[np.float32]:
+		''' Returns view of stem samples between start_time and end_time (in seconds)
+		'''
+		end_ind = None if end_time is None else int(end_time*self.FRAME_RATE)
+		return self.stems[type][int(start_time*self.FRAME_RATE):end_ind]
 			
 	def create_mash_stem(
 				self, new_stem_name: str, src_stem_type: str, start_sec: int, end_sec: int, shift_amt: int = None, 
-				bpm_ratio: float = None, target_song: MashSong = None) -> AudioSegment:
-		'''	Creates a AudioSegment stem based on a stem in this instance and shifts to 
+				bpm_ratio: float = None, target_song: MashSong = None) -> NDArray[np.float32]:
+		'''	Creates a stem based on a stem in this instance and shifts to 
 			target_key and target_bpm (or gets both from target_song). Saves new stem
 			to self.stems with key new_stem_name.
 
@@ -194,15 +229,14 @@ class MashSong:
 					(optional, overwrites target_key and target_bpm)
 
 		Returns:
-			AudioSegment object from base stem that matches target key and BPM
+			float32 samples from base stem that match target key and BPM
 		'''
 		path: Path = Path(__file__).parent.parent / "data/music/out"
 
 		try:
-			start_time:float = self.sections[start_sec].start_time*1000
-			end_time:float = self.sections[end_sec].end_time*1000
-			stem_segment: AudioSegment = self.stems[src_stem_type]
-			stem_segment = stem_segment[start_time:end_time]
+			start_time:float = self.sections[start_sec].start_time
+			end_time:float = self.sections[end_sec].end_time
+			stem_samples: NDArray[np.float32] = self.get_stem_slice(src_stem_type, start_time, end_time)
 		except KeyError as e:
 			raise KeyError(
 				f"No stem type of {src_stem_type} found in stems for {self.title}")
@@ -214,9 +248,11 @@ class MashSong:
 			mash_bpm: float = (self.bpm+target_song.bpm)/2
 			bpm_ratio: float = mash_bpm/self.bpm
 		
-		samples: NDArray[np.float32] = MashSong.convert_to_pedal(stem_segment)
-		pyrb_options={'--tempo':bpm_ratio,'--pitch':shift_amt,'-3':'-F'}
-		samples = pyrb(samples,self.FRAME_RATE,**pyrb_options)
+		# Pedalboard works on (channels, frames), stretch and pitch run in one in-process Rubber Band pass
+		samples: NDArray[np.float32] = stem_samples.T
+		if shift_amt != 0 or abs(bpm_ratio - 1.0) >= 1e-4:
+			samples = time_stretch(samples, self.FRAME_RATE, stretch_factor=bpm_ratio, 
+							pitch_shift_in_semitones=shift_amt, high_quality=True)
 
 		# pitched_samples = pyrb.pitch_shift(samples, 
 		# 						self.FRAME_RATE, shift_amt, rbargs={'-3':'-F'})
@@ -236,41 +272,28 @@ class MashSong:
 					PeakFilter(1000, -6.0, .5)
 					])
 
-		samples = board(samples, self.FRAME_RATE)
-
-		wav_io = io.BytesIO()
-		wavfile.write(wav_io, self.FRAME_RATE, samples)
-		wav_io.seek(0)
-		mash_stem = AudioSegment.from_wav(wav_io)
+		mash_stem: NDArray[np.float32] = np.ascontiguousarray(board(samples, self.FRAME_RATE).T)
 		self.stems[new_stem_name] = mash_stem
 		
-		mash_stem.export(path.parent/f"test/{self.title}editR3.wav", format="wav")
+		# EQ peaks can push past full scale, libsndfile would wrap them when converting to PCM_16
+		sf.write(path.parent/f"test/{self.title}editR3.wav", np.clip(mash_stem, -1, 1), self.FRAME_RATE, subtype='PCM_16')
 		return mash_stem
 
-	@classmethod
-	def convert_to_pedal(cls, seg:AudioSegment) -> NDArray[np.float32]:
-		channels = seg.split_to_mono()
-		samples = [s.get_array_of_samples() for s in channels]
-		audio = np.array(samples).T.astype(np.float32)
-		audio /= np.iinfo(samples[0].typecode).max
-		return audio
-
 	def get_longest_section(self, offset: int = 0) -> Section:
 		'''	Returns section with highest duration (index shifted by offset)
 		'''
-		sorted_sections = sorted(self.sections, key=lambda sec: sec.duration, reverse=True)
-		longest_section = sorted_sections[offset]
+		longest_section = self.sections[self._by_duration[offset]]
 		#longest_section.track_measures = self.measures
 		return longest_section
 
 	def sync_sections_to_measures(self) -> None:
-		''' Iterates through all sections and syncs to nearest measure
+		''' Syncs all sections to nearest measure in a single pass over the measures
 		'''
-		measures = self.measures
-		for section in self.sections:
-			section.track_measures = measures
-			end_ind = section.sync_to_measure()
-			measures = np.delete(measures, np.s_[:end_ind])
+		ends = np.fromiter((section.end_time for section in self.sections), 
+							dtype=np.float32, count=len(self.sections))
+		start_inds, end_inds = _sync_all(self.measures, ends)
+		for section, start_ind, end_ind in zip(self.sections, start_inds, end_inds):
+			section.sync_to_measure(self.measures, int(start_ind), int(end_ind))
 
 	# Log Methods
 	
@@ -291,92 +314,138 @@ class MashSong:
 			print(log_arr[ind])
 
 	def export_from_measures(self, start_measure: int, end_measure: int, type: str, out: str = None) -> None:
-		start_time = self.measures[start_measure]
-		end_time = self.measures[end_measure]
-		stem = self.stems[type]
 		if not out:
 			out = f"./data/music/measures/{self.title}{type}{start_measure}-{end_measure}.wav"
-
-		stem[start_time*1000:end_time*1000].export(out)
+		self.export_from_times(self.measures[start_measure], self.measures[end_measure], type, out)
 	
 	def export_from_times(self, start_time: float, end_time: float, type: str, out: str = None) -> None:
-		stem = self.stems[type]
+		''' Writes stem samples between start_time and end_time (in seconds) to a wav file
+		'''
 		if not out:
 			out = f"./data/music/measures/{self.title}{type}{start_time}-{end_time}.wav"
-		start_time = np.float16(start_time)*1000
-		end_time = np.float16(end_time)*1000
-		stem[start_time:end_time].export(out)
+		# Stems are unclipped float32, libsndfile would wrap samples past full scale when converting to PCM_16
+		sf.write(out, np.clip(self.get_stem_slice(type, float(start_time), float(end_time)), -1, 1), self.FRAME_RATE)
 
 	def export_from_sections(self, start: int, end: int, type: str, out: str = None) -> None:
-		start_sec = self.sections[start]
-		end_sec = self.sections[end]
-		stem = self.stems[type]
-		start_time = start_sec.start_time
-		end_time = end_sec.end_time
 		if not out:
 			out = f"./data/music/measures/{self.title}{type}{start}-{end}.wav"
-		stem[start_time*1000:end_time*1000].export(out)
+		self.export_from_times(self.sections[start].start_time, self.sections[end].end_time, type, out)
 
-	def measures_from_downbeat(self, info:dict):
+	def measures_from_downbeat(self):
 		beat_len = 60/self.bpm
 		search_end = beat_len * 16
-		segments = pd.DataFrame(info['segments'], columns=['start', 'loudness_max'])
-		search = segments[segments['start']<search_end]
-		downbeat = search.loc[search['loudness_max'].idxmax()][0]
+		# Segments are sorted by start, so the search window is a prefix (views, no mask copies)
+		search_len = np.searchsorted(self._segments_start, search_end, "left")
+		downbeat = self._segments_start[np.argmax(self._segments_loudness[:search_len])]
 		print(downbeat)
-		beats = [beat['start'] for beat in info['beats']]
-		beats = np.asarray(beats)
-		start_ind = np.searchsorted(beats, downbeat, "left")
-		measures = beats[start_ind::16]
-		measures = np.array(measures,np.float32)
+		start_ind = np.searchsorted(self._beats_start, downbeat, "left")
+		measures = self._beats_start[start_ind::16]
 		print(measures)
 		return measures
 
 # Helper Functions
 # async def 
 
-def bars_to_measures(bars: list) -> np.ndarray:
-	''' Converts list of bars into 1D np array
+def throttle(rate: float):
+	''' Decorator that limits calls to rate per second
+		(functions decorated by the same throttle share its limit)
 	'''
-	measure_list = bars[::4]
-	start_times = [bar['start'] for bar in measure_list]
-	measures = np.array(start_times,np.float32)
-	return measures
+	last_call: List[float] = [0.0]
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			wait = last_call[0] + 1/rate - time.monotonic()
+			if wait > 0:
+				time.sleep(wait)
+			last_call[0] = time.monotonic()
+			return func(*args, **kwargs)
+		return wrapper
+	return decorator
+
+_spotify_throttle = throttle(10)
+
+@_spotify_throttle
+def spotify_search(query: str) -> dict:
+	return MashSong._get_spotify().search(query, 1)
+
+@functools.lru_cache(maxsize=256)
+@_spotify_throttle
+def spotify_audio_analysis(uri: str) -> dict:
+	''' Fetches audio analysis for track uri, cached per uri for this session
+		(returned dict is shared, do not mutate)
+	'''
+	return MashSong._get_spotify().audio_analysis(uri)
 
-def beats_to_measures(beats: list) -> np.ndarray:
-	''' Converts list of beats into 1D np array
+@functools.lru_cache(maxsize=32)
+def _make_key(note: str, mode: str) -> key.Key:
+	''' Returns music21 Key shared by every MashSong in that key (only 24 exist)
 	'''
-	measure_list = beats[::16]
-	start_times = [bar['start'] for bar in measure_list]
-	measures = np.array(start_times,np.float32)
-	return measures
+	return key.Key(note, mode)
+
+@functools.lru_cache(maxsize=32)
+def _load_info(path_str: str) -> dict:
+	''' Parses track info json, cached by path so repeated loads skip the parse
+		(returned dict is shared, do not mutate)
+	'''
+	return orjson.loads(Path(path_str).read_bytes())
+
+@njit(cache=True)
+def _sync_all(measures, end_times):
+	''' Walks measures and section end times in lockstep, snapping each section end
+		to its closest measure. The start cursor never moves backwards.
+		Returns start and end measure indexes for every section
+	'''
+	starts = np.empty(end_times.size, np.intp)
+	ends = np.empty(end_times.size, np.intp)
+	last = measures.size - 1
+	cursor = 0
+	for i in range(end_times.size):
+		end_time = end_times[i]
+		ind = cursor
+		while ind < measures.size and measures[ind] < end_time:
+			ind += 1
+		end_ind = max(min(ind - 1, last - 1), cursor)
+		# Branchless snap to the next measure when it is closer (never past the last one)
+		next_ind = min(end_ind + 1, last)
+		end_ind += int((next_ind > end_ind) & 
+					(end_time - measures[end_ind] > measures[next_ind] - end_time))
+		starts[i] = cursor
+		ends[i] = end_ind
+		cursor = end_ind
+	return starts, ends
+
+def field_array(items: list, field: str) -> NDArray[np.float32]:
+	''' Pulls one field from a list of Spotify analysis dicts into a float32 array
+	'''
+	return np.fromiter((item[field] for item in items), np.float32, len(items))
+
+def bars_to_measures(bars_start: NDArray[np.float32]) -> np.ndarray:
+	''' Takes every 4th bar start as a measure (view, no copy)
+	'''
+	return bars_start[::4]
+
+def beats_to_measures(beats_start: NDArray[np.float32]) -> np.ndarray:
+	''' Takes every 16th beat start as a measure (view, no copy)
+	'''
+	return beats_start[::16]
 
-def measures_from_confident_beat(beats: list) -> np.ndarray:
-	confidences = [beat['confidence'] for beat in beats[0:2]]
-	start = confidences.index(max(confidences))
+def measures_from_confident_beat(beats_start: NDArray[np.float32], beats_conf: NDArray[np.float32]) -> np.ndarray:
+	start = int(beats_conf[0:2].argmax())
 	print(start)
-	measure_list = beats[start::16]
-	start_times = [bar['start'] for bar in measure_list]
-	print(start_times)
-	measures = np.array(start_times,np.float32)
+	measures = beats_start[start::16]
+	print(measures)
 	return measures
 
-def find_measures(info: dict):
-	bars = info['bars']
-	beats = info['beats']
-	bar_conf_list = np.asarray([bar['confidence'] for bar in bars])
-	beat_conf_list = np.asarray([beat['confidence'] for beat in beats])
-	print(beat_conf_list)
-	best_bar_ind = bar_conf_list.index(max(bar_conf_list))
-	best_beat_ind = beat_conf_list.index(max(beat_conf_list))
-	print(bars[best_bar_ind]['start'])
-	avg_beat_length = 60/info['track']['tempo']
+def find_measures(bars_start: NDArray[np.float32], bars_conf: NDArray[np.float32], tempo: float, duration: float):
+	best_bar_ind = int(bars_conf.argmax())
+	print(bars_start[best_bar_ind])
+	avg_beat_length = 60/tempo
 	avg_bar_length = avg_beat_length*4
-	start_time = bars[best_bar_ind]['start']
+	start_time = bars_start[best_bar_ind]
 	while start_time > 0:
 		start_time = start_time - (avg_bar_length*4)
 	start_time = start_time+(avg_bar_length*4)
-	measures = np.arange(start_time, info['track']['duration'], avg_bar_length*4)
+	measures = np.arange(start_time, duration, avg_bar_length*4)
 	return measures
 
 def find_closest_bpm(self_bpm, target_bpm):
@@ -389,29 +458,16 @@ def find_closest_bpm(self_bpm, target_bpm):
 			self_bpm = self_bpm/2
 	return self_bpm
 
-def find_closest_key_shift(self: MashSong, target: MashSong):
-	diff = 1
-	print(f"{self.key}/{self.key.relative}/{self.key.parallel}")
-	print(f"{target.key}/{target.key.relative}/{target.key.parallel}")
-	
-	while(True):
-		new_key = self.key.transpose(diff)
-		print(f"NewKey: {new_key}/{new_key.pitchFromDegree(1)}/{new_key.pitchFromDegree(1).ps}")
-		if(new_key.pitchFromDegree(1).ps == target.key.pitchFromDegree(1).ps and new_key.mode == target.key.mode):
-			break
-		elif(new_key.pitchFromDegree(1).ps == target.key.relative.pitchFromDegree(1).ps and new_key.mode == target.key.relative.mode):
-			break
-		diff += 1
+def find_closest_key_shift(self: MashSong, target: MashSong) -> int:
+	''' Returns semitones to shift self towards target's key, or towards its relative key
+		when modes differ. Only half the interval, as both songs shift to meet in the middle
+	'''
+	target_no = target.key_no
+	if(self.mode != target.mode):
+		target_no += 3 if target.mode == 'minor' else -3	# tonic of target.key.relative
+	diff = (target_no - self.key_no) % 12 or 12
 	if(diff > 6):
 		diff = -12.1 + diff
 	else:
 		diff = diff - .1
-	diff = round(diff/2)
-	print(f"Original Key: {self.key}/{self.key.relative} + {diff}")
-	new_key = self.key.transpose(diff)
-	print(f"Key: {new_key}/{new_key.relative}")
-	return diff
-
-	
-
-
+	return round(diff/2)
@@ -1,15 +1,19 @@
 from __future__ import annotations, division
 import os
 import re
+import sys
 import urllib3
 import logging
+import threading
 import subprocess
+import multiprocessing
 
-from typing import Tuple, Type
+from typing import Dict, Tuple, Type, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pytube import YouTube
 from pathlib import Path
 
-from pydub import AudioSegment
+import soundfile as sf
 from mashdata import MashSong, Section
 from pedalboard.io import AudioFile
 from pedalboard.pedalboard import Pedalboard
@@ -17,67 +21,98 @@ from pedalboard import *
 import numpy as np
 
 logger = logging.getLogger(__name__)
+_YT_ID_RE = re.compile(rb"watch\?v=(\S{11})")
+_HTTP = urllib3.PoolManager(num_pools=4, maxsize=4, 
+							retries=urllib3.Retry(total=3, backoff_factor=0.5, 
+											status_forcelist=(429, 500, 502, 503)))
 
 class Masher:
 	'''	Interface to download and separate audio.
 	'''
 
 	audio_loader: object = None
-	separator: object = None
+	separator_type: type = None
+	separators: Dict[str, object] = {}	# Separator instances keyed by sep_config
+	spleeter_lock: threading.Lock = threading.Lock()
 	sep_config: str = "spleeter:2stems"
 	sample_rate: float = 44100
 	save_data: bool = True
+	multiprocess: bool = True
+	buffer_size: int = 8192		# frames per block when streaming mashes to disk
 
 	@classmethod
-	def separate(cls, filename: str, ) -> dict:
+	def separate(cls, filename: str, waveform: Optional[np.ndarray] = None) -> dict:
 		''' Separates stems from wav file and returns dict of stems
 
 		Args:
 			filename (str): Track wav file, must be in /data/music/src
+			waveform (np.ndarray): Already decoded track audio, skips reading filename (optional)
 			sample_rate (int): Sample rate for output (default = 44100)
 			save_data (bool): Whether to save stem .wav file locally
 		
 		Returns:
 			dict with stem names as keys and np.ndarray audio data as value
 		'''
-		if cls.audio_loader is None:
-			logging.getLogger("tensorflow").setLevel(logging.CRITICAL)
-			logger.info("Loading spleeter libraries")
-			from spleeter.separator import Separator
-			from spleeter.audio.adapter import AudioAdapter 
-			logging.getLogger("spleeter").setLevel(logging.CRITICAL)
-			
-		cls.audio_loader = AudioAdapter.default()
-		cls.separator = Separator(cls.sep_config, multiprocess=True,)
-		path = Path.cwd() / 'data/music/src'
-		file = path / f"{filename}.wav"
+		with cls.spleeter_lock:
+			if cls.audio_loader is None:
+				os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+				logging.getLogger("tensorflow").setLevel(logging.CRITICAL)
+				logger.info("Loading spleeter libraries")
+				from spleeter.separator import Separator
+				from spleeter.audio.adapter import AudioAdapter 
+				logging.getLogger("spleeter").setLevel(logging.CRITICAL)
+				cls.separator_type = Separator
+				cls.audio_loader = AudioAdapter.default()
+			if cls.sep_config not in cls.separators:
+				cls.separators[cls.sep_config] = cls.separator_type(cls.sep_config, multiprocess=cls.multiprocess,)
+			separator = cls.separators[cls.sep_config]
+
+		if waveform is None:
+			path = Path.cwd() / 'data/music/src'
+			file = path / f"{filename}.wav"
+			waveform, _ = cls.audio_loader.load(file, sample_rate=cls.sample_rate)
 		logger.info("Separating audio...")
-		waveform, _ = cls.audio_loader.load(file, sample_rate=cls.sample_rate)
-		prediction = cls.separator.separate(waveform)
+		prediction = separator.separate(waveform)
 
 		if cls.save_data:
 			path = Path.cwd() / 'data/music/out'
 			filename = filename.removesuffix('.wav')
-			for key, value in prediction.items():
-				out = f"{filename}{str(key)[0].capitalize()}.wav"
+			def save_stem(key: str, value: np.ndarray) -> None:
+				out = f"{filename}{cls.stem_name(key)}.wav"
 				file = path / out
 				cls.audio_loader.save(file, value, cls.sample_rate, bitrate="32")
 				logger.info(f"{out} saved successfully")
+			with ThreadPoolExecutor() as pool:
+				list(pool.map(save_stem, prediction.keys(), prediction.values()))
 
-		del cls.audio_loader
-		del cls.separator
 		return prediction
 
+	@classmethod
+	def stem_name(cls, key: str) -> str:
+		''' Returns stem name used in saved filenames and MashSong.stems for a spleeter stem key
+		'''
+		return str(key)[0].capitalize()
+
 	@classmethod
 	def separate_from_list(cls, wav_list: list) -> None:
 		''' Takes a list of filenames and separates each into stems
+			(one worker process per two cores, each keeps its Separator across files)
 		'''
-		for filename in wav_list:
-			cls.separate(filename)
+		workers = max(1, min(len(wav_list), (os.cpu_count() or 2)//2))
+		# fork is only safe before spleeter/TensorFlow has started its thread pools in this process
+		if sys.platform.startswith("linux") and not cls.separators:
+			context = multiprocessing.get_context("fork")
+		else:
+			context = multiprocessing.get_context("spawn")
+		with ProcessPoolExecutor(max_workers=workers, mp_context=context, 
+								initializer=init_separate_worker) as pool:
+			for filename, _ in zip(wav_list, pool.map(separate_worker, wav_list)):
+				logger.info(f"{filename} separated")
 
 	@classmethod
-	def get_yt_song(cls, query: str, out: str):
+	def get_yt_song(cls, query: str, out: str) -> np.ndarray:
 		''' Takes YouTube search query and downloads first result, converting to wav
+			Returns decoded float32 audio so later stages don't read the wav again
 		'''
 
 		def get_yt_url(query: str) -> str:
@@ -86,10 +121,8 @@ class Masher:
 			'''
 			keywords = query.replace(" ", "+")
 			query = f"https://www.youtube.com/results?search_query={keywords}"
-			http = urllib3.PoolManager()
-			response = http.request('GET', query)
-			html = response.data
-			top_video_id = re.findall(r"watch\?v=(\S{11})", html.decode())[0]
+			response = _HTTP.request('GET', query)
+			top_video_id = _YT_ID_RE.search(response.data).group(1).decode()
 			url = f"https://www.youtube.com/watch?v={top_video_id}"
 			logger.info(f"Downloading from {url}")
 			return url
@@ -104,21 +137,24 @@ class Masher:
 			mp4.download('./data/music/download', filename=out)
 			logger.info(f"Downloading {mp4.title}")
 
-		def convert_mp4_wav(file: str):
-			''' Takes mp4 file and converts to wav file
+		def convert_mp4_wav(file: str) -> Path:
+			''' Takes mp4 file and converts to wav file, returns wav path
 			'''
 			file_in = Path.cwd() / 'data/music/download' / f"{file}.mp4"
 			out = Path.cwd() / 'data/music/src' / f"{file}.wav"
-			cmd = f"ffmpeg -i {file_in} -ab 160k -ac 2 -ar 44100 -vn {out} -loglevel quiet"
+			cmd = ["ffmpeg", "-y", "-i", str(file_in), "-ab", "160k", "-ac", "2", "-ar", "44100", 
+					"-vn", str(out), "-loglevel", "quiet"]
 			logger.info(f"Converting to wav: {file_in}")
-			subprocess.call(cmd)
+			subprocess.run(cmd, check=True)
 			logger.info(f"Converted wav saved in {out}")
 			if out.exists():
 				os.remove(file_in)
+			return out
 
 		url = get_yt_url(query)
 		get_yt_download(url, out)
-		convert_mp4_wav(out)
+		waveform, _ = sf.read(convert_mp4_wav(out), dtype='float32', always_2d=True)
+		return waveform
 
 
 	@classmethod
@@ -137,29 +173,31 @@ class Masher:
 		logger.info("Matching pitch and beat")
 		voc_stem = voc.create_mash_stem("VocMash","Vocals", voc_secs[0], voc_secs[1], target_song=acc)
 		acc_stem = acc.create_mash_stem("AccMash","Accompaniment", acc_secs[0], acc_secs[1], target_song=voc)
-		logger.info("Overlaying audio")
-		if(voc_stem.duration_seconds > acc_stem.duration_seconds):
-			mash = acc_stem.overlay(voc_stem)
-		else: 
-			mash = voc_stem.overlay(acc_stem)
-		audio = MashSong.convert_to_pedal(mash)
 		board = Pedalboard([
 					Compressor(threshold_db=-20,ratio=2, attack_ms=30, release_ms=20),
 					Reverb(room_size=.3,damping=.3,wet_level=.25,dry_level=.7)
 					])
-		effected = board(audio,44100)
 
+		logger.info("Overlaying audio")
+		# Mix, effect and write one block at a time so the full mash is never held in memory
+		# (shorter stem is zero-padded to the length of the longer one)
+		length = max(len(voc_stem), len(acc_stem))
 		path = Path.cwd() / 'data/music/mash' / output
 		with AudioFile(str(path), 'w', 44100, num_channels=2, quality=160) as f:
-			f.write(effected)
+			for start in range(0, length, cls.buffer_size):
+				end = min(start + cls.buffer_size, length)
+				block = np.zeros((end - start, 2), np.float32)
+				for stem in (voc_stem, acc_stem):
+					stem_block = stem[start:end]
+					block[:len(stem_block)] += stem_block
+				f.write(board.process(block.T, 44100, reset=(start == 0)))
 		logger.info(f"Mash saved to {path}")
 
 	@classmethod
 	def export_section_from_stem(cls, ind: int, song: MashSong, type: str):
 		section = song.sections[ind]
-		stem = song.stems[type]
 		out = f"./data/music/sections/{song.title}{type}{ind}.wav"
-		stem[section.start_time*1000:section.end_time*1000].export(out)
+		song.export_from_times(section.start_time, section.end_time, type, out)
 
 	@classmethod
 	def get_song(cls, out: str, query: str = "", artist: str = ""):
@@ -167,13 +205,29 @@ class Masher:
 		path = Path(f"./data/info/{file}.json")
 		if(path.is_file()):
 			return MashSong.get_song_from_json(f"{file}.json")
-		cls.get_yt_song(f"{out} {query} {artist}".rstrip(), file)
-		cls.separate(file)
-		return MashSong.get_song_from_search(out, artist)
+		waveform = cls.get_yt_song(f"{out} {query} {artist}".rstrip(), file)
+		prediction = cls.separate(file, waveform)
+		stems = {cls.stem_name(key): value.astype(np.float32, copy=False) for key, value in prediction.items()}
+		return MashSong.get_song_from_search(out, artist, stems=stems)
 	
 
 
 # Helper Methods		
+def init_separate_worker() -> None:
+	''' Pins TensorFlow threads before spleeter loads so workers don't oversubscribe cores
+		(drops any loader/separators inherited from the parent so they're rebuilt with these settings)
+	'''
+	os.environ["TF_NUM_INTRAOP_THREADS"] = "2"
+	os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+	Masher.multiprocess = False
+	Masher.audio_loader = None
+	Masher.separators = {}
+
+def separate_worker(filename: str) -> None:
+	''' Runs Masher.separate in a worker without sending stems back to the parent
+	'''
+	Masher.separate(filename)
+
 # skele: 80 supa: 128
 def calc_tempo(bpm: float, tarBpm: float):
 	if(bpm > tarBpm):
@@ -13,8 +13,10 @@ hop_length = int(librosa.time_to_samples(1./fps, sr=sr))
 
 y, sr = librosa.load(str(path/"DieForYou.wav"), duration=15, sr=sr)
 
-chroma = librosa.feature.chroma_stft(y, sr=sr, n_fft=n_fft, hop_length=hop_length)
-flux = librosa.onset.onset_strength(S=chroma, sr=sr, hop_length=512)
+# One power spectrogram shared by chroma and flux
+D = np.abs(librosa.stft(y, n_fft=n_fft, hop_length=hop_length))**2
+chroma = librosa.feature.chroma_stft(S=D, sr=sr, n_fft=n_fft, hop_length=hop_length)
+flux = librosa.onset.onset_strength(S=librosa.power_to_db(D), sr=sr, hop_length=hop_length)
 
 frame_time = librosa.frames_to_time(np.arange(len(flux)), sr=sr, hop_length=hop_length)
 